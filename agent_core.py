@@ -0,0 +1,621 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+agent_core.py - v1/v2 共用的工具层
+
+TOOLS 定义、危险命令拦截、常驻 shell、文件读写等原先在
+v1_basic_agent.py 和 v2_async_agent.py 里各复制了一份，
+任何优化都得改两处。抽到这里之后只维护一份：
+- v1 直接调 execute_tool_sync；
+- v2 把 execute_tool_sync 丢进线程池。
+"""
+
+import atexit
+import hashlib
+import json
+import mmap
+import os
+import re
+import selectors
+import subprocess
+import threading
+import time
+import uuid
+from pathlib import Path
+
+# 工作目录固定为当前目录，避免越界
+WORKDIR = Path.cwd()
+
+# JSON 解析优先用 orjson（C 实现，解析快 2-3 倍）；没装就退回标准库。
+# 两者的解析错误都是 ValueError 子类，调用方统一按 ValueError 捕获。
+try:
+    import orjson
+
+    def json_loads(s):
+        return orjson.loads(s)
+except ImportError:
+    json_loads = json.loads
+
+# -----------------------------------------------------------------------------
+# 系统提示词模板（mode_rules 由 v1/v2 各自填入同步/异步的行为约定）
+# -----------------------------------------------------------------------------
+
+SYSTEM_TEMPLATE = """你是一名在目录 {workdir} 里的编码 Agent。
+
+{mode_rules}
+
+通用规则：
+- 不要凭空猜文件路径，不确定就先 ls/find。
+- 需要连续跑多条命令时，用 bash_batch 一次提交，别逐条调 bash。
+- 修改要最小化，不要过度设计。"""
+
+# -----------------------------------------------------------------------------
+# 工具定义（告诉模型有哪些工具可用）
+# -----------------------------------------------------------------------------
+
+TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "bash",
+            "description": "执行任意 Shell 命令，如 ls、find、grep、git、npm、python 等。",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "command": {"type": "string", "description": "要运行的 shell 命令"}
+                },
+                "required": ["command"],
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "bash_batch",
+            "description": "按顺序执行多条 Shell 命令（单个进程内完成），返回每条命令的输出和退出码。连续执行多条命令时优先用它。",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "commands": {
+                        "type": "array",
+                        "items": {"type": "string"},
+                        "description": "要依次运行的 shell 命令列表",
+                    }
+                },
+                "required": ["commands"],
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "read_file",
+            "description": "读取文件内容（UTF-8）。可选 limit 只读前 N 行。",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "path": {"type": "string", "description": "相对路径"},
+                    "limit": {"type": "integer", "description": "最多读取的行数"},
+                },
+                "required": ["path"],
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "write_file",
+            "description": "写入文件（创建或覆盖），自动创建父目录。",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "path": {"type": "string", "description": "相对路径"},
+                    "content": {"type": "string", "description": "写入的全文内容"},
+                },
+                "required": ["path", "content"],
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "edit_file",
+            "description": "对文件做精确替换：用 new_text 替换第一次出现的 old_text。",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "path": {"type": "string", "description": "相对路径"},
+                    "old_text": {"type": "string", "description": "待替换的原文（需精确匹配）"},
+                    "new_text": {"type": "string", "description": "替换后的文本"},
+                },
+                "required": ["path", "old_text", "new_text"],
+            },
+        },
+    },
+]
+
+# -----------------------------------------------------------------------------
+# 安全与截断
+# -----------------------------------------------------------------------------
+
+# 危险命令黑名单：编译成单个正则，一次扫描代替 K 次子串查找，
+# 词边界 \b 避免 "shutdown" 误伤 "myshutdown.sh" 这类路径
+DANGER_RE = re.compile(
+    r"\brm\s+-rf\s+/|\bsudo\b|\bshutdown\b|\breboot\b|>\s*/dev/",
+    re.IGNORECASE,
+)
+
+# 单条工具结果允许占用的 token 预算（真正的成本是喂回模型的 token，不是字符）
+MAX_TOOL_TOKENS = 1500
+
+
+def truncate_tool_output(text: str, max_tokens: int = MAX_TOOL_TOKENS) -> str:
+    """
+    按 token 截断工具输出（粗估：中英混排 1 token ≈ 3 字符）。
+    超限时保留开头 60% + 结尾 20%，中间用标记占位——
+    头部通常是关键信息，尾部常有报错/退出状态，中间最可以丢。
+    """
+    est = len(text) // 3
+    if est <= max_tokens:
+        return text
+    head = int(max_tokens * 0.6) * 3
+    tail = int(max_tokens * 0.2) * 3
+    dropped = est - max_tokens
+    return text[:head] + f"\n...(中间截断约 {dropped} tokens)...\n" + text[-tail:]
+
+
+def safe_path(p: str) -> Path:
+    """
+    确保路径留在工作区内，防止通过 ../ 越界访问。
+    """
+    path = (WORKDIR / p).resolve()
+    if not path.is_relative_to(WORKDIR):
+        raise ValueError(f"路径越界：{p}")
+    return path
+
+
+# -----------------------------------------------------------------------------
+# 历史体量估算（压缩触发的兜底计量；精确值来自 response.usage）
+# -----------------------------------------------------------------------------
+
+# deepseek-chat 上下文按 64K 保守估计，超过 75% 就触发压缩
+CTX_LIMIT = 64_000
+COMPRESS_AT = int(CTX_LIMIT * 0.75)
+# 给下一轮回复和工具结果预留的 token 余量
+FORWARD_BUFFER = 8_000
+# pivot 兜底：单任务的长工具循环里往往只有开头一条 user 消息
+# （最近 user 之前没有可折叠的前缀），这时改按“保留最近 N 条”选切点
+KEEP_RECENT = 8
+
+P_HIST = (
+    "你是对话压缩器。把下面的 Agent 执行历史压缩成一段简洁的中文纪要，"
+    "保留：已完成的操作、关键文件/命令、重要结论和未完成事项。不要编造。"
+)
+
+
+def estimate_tokens(messages: list) -> int:
+    """粗略估算 token 数：中英混排按 1 token ≈ 3 字符，外加每条消息的固定开销。"""
+    total = 0
+    for m in messages:
+        total += len(str(m.get("content") or "")) // 3 + 8
+    return total
+
+
+# -----------------------------------------------------------------------------
+# bash：常驻 shell + 批量执行
+# -----------------------------------------------------------------------------
+
+class PersistentShell:
+    """
+    常驻 bash 进程：所有 bash 工具调用共享同一个 shell。
+    - 免去每次 fork+exec+shell 启动的开销（约 10-30ms/次）。
+    - cwd、export、venv 激活等状态跨调用保留，模型不用每轮重新 cd。
+    每条命令结束后打印随机 sentinel + 退出码，读到 sentinel 即收齐输出；
+    超时或 shell 意外退出就杀掉重建（状态丢失，但下一条命令照常可用）。
+    工具调用可能并发，用线程锁串行化对 shell 的访问。
+    """
+
+    def __init__(self):
+        self.proc: subprocess.Popen | None = None
+        self.lock = threading.Lock()
+
+    def _ensure(self) -> None:
+        if self.proc is None or self.proc.poll() is not None:
+            self.proc = subprocess.Popen(
+                ["bash", "--noprofile", "--norc"],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                bufsize=0,
+                cwd=WORKDIR,
+            )
+
+    def _restart(self) -> None:
+        try:
+            if self.proc is not None:
+                self.proc.kill()
+        except Exception:
+            pass
+        self.proc = None
+
+    def run(self, command: str, timeout: float = 60.0, strip: bool = True) -> str:
+        with self.lock:
+            try:
+                self._ensure()
+            except Exception as e:
+                return f"Error: {e}"
+
+            marker = f"__END_{uuid.uuid4().hex}__"
+            # 命令包进 { } 组并把 stdin 接到 /dev/null：否则 cat/python 这类
+            # 读 stdin 的命令会把 sentinel printf 当输入吃掉再原样吐出来，
+            # 之后每条命令都喂给还活着的它，整个 shell 就永久废了
+            self.proc.stdin.write(
+                ("{\n" + command + "\n} </dev/null"
+                 + f'\nprintf "\\n{marker} %d\\n" $?\n').encode()
+            )
+            self.proc.stdin.flush()
+
+            buf = b""
+            deadline = time.monotonic() + timeout
+            sel = selectors.DefaultSelector()
+            sel.register(self.proc.stdout, selectors.EVENT_READ)
+            try:
+                while True:
+                    remain = deadline - time.monotonic()
+                    if remain <= 0:
+                        self._restart()
+                        return f"Error: 命令超时 ({int(timeout)}s)，shell 已重启"
+                    if not sel.select(remain):
+                        continue
+                    chunk = os.read(self.proc.stdout.fileno(), 65536)
+                    if not chunk:
+                        self._restart()
+                        return "Error: shell 意外退出，已重启"
+                    buf += chunk
+                    idx = buf.find(marker.encode())
+                    if idx != -1:
+                        line = buf[idx:].split(b"\n", 1)[0].decode()
+                        rc = line[len(marker):].strip()
+                        output = buf[:idx].decode("utf-8", "replace")
+                        if strip:
+                            # 注意 strip=False 给 bash_batch 用：\x1e 在 Python
+                            # 里算空白字符，strip 会吃掉首尾的分隔符
+                            output = output.strip()
+                        return f"[exit {rc}]\n{output}" if output else f"[exit {rc}] (no output)"
+            finally:
+                sel.close()
+
+
+SHELL = PersistentShell()
+
+
+def run_bash(command: str) -> str:
+    """
+    在常驻 shell 里执行命令，附带简单安全限制与超时。
+    - 拦截明显危险的模式。
+    - 超时 60 秒（超时后 shell 重建）。
+    - 输出按 token 预算截断，避免撑爆上下文。
+    """
+    if DANGER_RE.search(command):
+        return "Error: 危险命令已拦截"
+    return truncate_tool_output(SHELL.run(command))
+
+
+# 批量命令结果的分隔符（record separator，正常输出里几乎不会出现）
+BATCH_SEP = "\x1e"
+
+
+def run_bash_batch(commands: list) -> str:
+    """
+    把一串命令合进一次 shell 往返，省掉 N-1 次调用开销。
+    跑在和 bash 工具同一个常驻 shell 里：之前批量走独立的 subprocess.run，
+    bash 里 cd/export 过的状态对 batch 不可见，批量命令会默默在错误目录执行。
+    每条命令后打印分隔符包裹的退出码，事后按分隔符拆回逐条结果。
+    """
+    for cmd in commands:
+        if DANGER_RE.search(cmd):
+            return f"Error: 危险命令已拦截 ({cmd})"
+
+    script = "\n".join(
+        f"{cmd}\nprintf '{BATCH_SEP}%d{BATCH_SEP}\\n' $?" for cmd in commands
+    )
+    raw = SHELL.run(script, strip=False)
+    if raw.startswith("Error:"):
+        return raw
+
+    # SHELL.run 返回 "[exit rc]\n<输出>"，批量只关心输出部分；
+    # 输出片段依次是 [输出1, 退出码1, 输出2, 退出码2, ...]
+    _, _, body = raw.partition("\n")
+    parts = body.split(BATCH_SEP)
+    blocks = []
+    for i, cmd in enumerate(commands):
+        out = parts[2 * i].strip() if 2 * i < len(parts) else ""
+        rc = parts[2 * i + 1].strip() if 2 * i + 1 < len(parts) else "?"
+        blocks.append(f"$ {cmd}\n[exit {rc}]\n{out or '(no output)'}")
+    return truncate_tool_output("\n\n".join(blocks))
+
+
+# -----------------------------------------------------------------------------
+# 文件读写
+# -----------------------------------------------------------------------------
+
+def run_read(path: str, limit: int | None = None) -> str:
+    """
+    读取文件，可指定 limit 仅返回前 N 行；输出按 token 预算截断。
+    用 mmap 按需切片：只解码真正要返回的那一段字节，
+    大文件（比如 100MB 日志取前 50 行）不会整只读进内存再 splitlines。
+    """
+    try:
+        fp = safe_path(path)
+        with open(fp, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return ""
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mmap, "MADV_SEQUENTIAL"):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+
+                if limit:
+                    # 逐个定位第 limit 个换行，而不是整文件 splitlines
+                    pos, count = 0, 0
+                    while count < limit:
+                        nxt = mm.find(b"\n", pos)
+                        if nxt == -1:
+                            pos = len(mm)
+                            break
+                        pos = nxt + 1
+                        count += 1
+                    text = mm[:pos].decode("utf-8", "replace").rstrip("\n")
+                    if pos < len(mm):
+                        # 数剩余行数同样走 find 游标：mm[pos:] 会把文件尾
+                        # 整块复制成 bytes，大文件上就是白白一次全量分配
+                        remaining, scan = 0, pos
+                        while True:
+                            nxt = mm.find(b"\n", scan)
+                            if nxt == -1:
+                                break
+                            remaining += 1
+                            scan = nxt + 1
+                        if scan < len(mm):  # 最后一行没有换行符
+                            remaining += 1
+                        text += f"\n... (还有 {remaining} 行)"
+                    return truncate_tool_output(text)
+
+                # 无 limit：小文件整读；大文件只解码头尾，中间根本不碰
+                size = len(mm)
+                budget = MAX_TOOL_TOKENS * 3  # 字符预算（1 token ≈ 3 字符）
+                if size <= budget * 2:
+                    return truncate_tool_output(mm[:].decode("utf-8", "replace"))
+                head = mm[: int(budget * 0.6)].decode("utf-8", "replace")
+                tail = mm[size - int(budget * 0.2):].decode("utf-8", "replace")
+                dropped = (size - int(budget * 0.8)) // 3
+                return f"{head}\n...(中间截断约 {dropped} tokens)...\n{tail}"
+    except Exception as e:
+        return f"Error: {e}"
+
+
+# 已写文件的内容哈希缓存：key=路径，value=((mtime_ns, size), hash)。
+# 文件没被外部动过时可以直接比哈希，省掉一次全文件重读
+_WRITE_HASHES: dict[str, tuple[tuple[int, int], bytes]] = {}
+
+
+def _content_hash(data: bytes) -> bytes:
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def run_write(path: str, content: str) -> str:
+    """
+    写文件（创建或覆盖），会自动建父目录。
+    - 内容没变就跳过：模型经常一字不差地重写整份文件。
+    - 先写临时文件再 os.replace：写到一半崩溃也不会留下半截文件。
+    """
+    try:
+        fp = safe_path(path)
+        data = content.encode("utf-8")
+        new_hash = _content_hash(data)
+
+        if fp.exists():
+            st = fp.stat()
+            stat_key = (st.st_mtime_ns, st.st_size)
+            cached = _WRITE_HASHES.get(str(fp))
+            if cached and cached[0] == stat_key:
+                old_hash = cached[1]
+            elif st.st_size == len(data):  # 大小都不同就没必要读了
+                old_hash = _content_hash(fp.read_bytes())
+            else:
+                old_hash = None
+            if old_hash == new_hash:
+                return f"No change: {path} 内容相同，跳过写入"
+
+        fp.parent.mkdir(parents=True, exist_ok=True)
+        tmp = fp.with_suffix(fp.suffix + f".{os.getpid()}.tmp")
+        tmp.write_bytes(data)
+        if fp.exists():
+            # tmp 按默认 umask 创建，replace 前把原文件权限搬过来，
+            # 否则覆盖可执行脚本会悄悄抹掉 exec 位
+            os.chmod(tmp, fp.stat().st_mode)
+        os.replace(tmp, fp)
+        st = fp.stat()
+        _WRITE_HASHES[str(fp)] = ((st.st_mtime_ns, st.st_size), new_hash)
+        return f"Wrote {len(content)} bytes to {path}"
+    except Exception as e:
+        return f"Error: {e}"
+
+
+def run_edit(path: str, old_text: str, new_text: str) -> str:
+    """
+    精确替换文件中的第一处 old_text，避免大面积误替换。
+    mmap + bytes.find 定位（一次 C 级扫描，代替 `in` + `replace` 两遍），
+    然后把 头/替换文本/尾 三段直写临时文件，不在内存里拼整份新串；
+    os.replace 落盘保证原子性。
+    """
+    try:
+        fp = safe_path(path)
+        old_bytes = old_text.encode("utf-8")
+        new_bytes = new_text.encode("utf-8")
+        with open(fp, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return f"Error: 未找到要替换的内容 ({path})"
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                idx = mm.find(old_bytes)
+                if idx == -1:
+                    return f"Error: 未找到要替换的内容 ({path})"
+                tmp = fp.with_suffix(fp.suffix + f".{os.getpid()}.tmp")
+                with open(tmp, "wb") as out:
+                    out.write(mm[:idx])
+                    out.write(new_bytes)
+                    out.write(mm[idx + len(old_bytes):])
+                # 保留原文件权限（可执行位等），tmp 是按默认 umask 建的
+                os.chmod(tmp, os.fstat(f.fileno()).st_mode)
+        os.replace(tmp, fp)
+        return f"Edited {path}"
+    except Exception as e:
+        return f"Error: {e}"
+
+
+# -----------------------------------------------------------------------------
+# 元工具融合（实验特性，ENABLE_META_TOOLS=1 开启）
+# -----------------------------------------------------------------------------
+# 模型经常重复同一种两步工具序列（比如 bash grep 完马上 read_file）。
+# 统计相邻 (工具A -> 工具B) 名字对并跨会话持久化；某个对子出现 >= 3 次
+# 就注册一个融合 meta 工具，让模型可以一次调用跑完两步，省一趟模型往返。
+
+META_TOOLS_ENABLED = os.getenv("ENABLE_META_TOOLS") == "1"
+META_STATS_PATH = Path(".agent_cache") / "meta_tools.json"
+META_FUSE_AT = 3
+
+_BASE_TOOL_NAMES = {t["function"]["name"] for t in TOOLS}
+
+
+def _load_meta_stats() -> dict:
+    try:
+        return json.loads(META_STATS_PATH.read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+_META_STATS: dict[str, int] = _load_meta_stats()  # {"bash->read_file": 次数}
+_REGISTERED_PAIRS: set[str] = set()
+_PENDING_META: list[dict] = []  # 攒出来、等主线程并入 TOOLS 的融合工具
+_LAST_TOOL: list[str] = []  # 最近一次工具名（单元素列表，跨调用可变）
+_META_LOCK = threading.Lock()
+_META_DIRTY = False  # 有未落盘的计数更新
+
+
+def _save_meta_stats() -> None:
+    try:
+        META_STATS_PATH.parent.mkdir(exist_ok=True)
+        META_STATS_PATH.write_text(json.dumps(_META_STATS, indent=2))
+    except OSError:
+        pass
+
+
+@atexit.register
+def _flush_meta_stats() -> None:
+    """进程退出时把攒着的计数落一次盘（平时只在状态变化时写）。"""
+    global _META_DIRTY
+    with _META_LOCK:
+        if _META_DIRTY:
+            _save_meta_stats()
+            _META_DIRTY = False
+
+
+def _maybe_register_meta_tools() -> None:
+    """把出现次数达标的工具对装配成融合工具，先进待并入队列。"""
+    for pair, count in list(_META_STATS.items()):
+        if count < META_FUSE_AT or pair in _REGISTERED_PAIRS:
+            continue
+        t1, _, t2 = pair.partition("->")
+        if t1 not in _BASE_TOOL_NAMES or t2 not in _BASE_TOOL_NAMES:
+            continue  # 不融合 meta 套 meta
+        _PENDING_META.append({
+            "type": "function",
+            "function": {
+                "name": f"meta_{t1}_then_{t2}",
+                "description": f"融合工具：依次执行 {t1} 和 {t2}，一次调用返回两步的结果。",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "first_args": {"type": "object", "description": f"{t1} 的参数"},
+                        "second_args": {"type": "object", "description": f"{t2} 的参数"},
+                    },
+                    "required": ["first_args", "second_args"],
+                },
+            },
+        })
+        _REGISTERED_PAIRS.add(pair)
+
+
+def apply_pending_meta_tools() -> None:
+    """
+    把攒好的融合工具并入 TOOLS。必须在轮与轮之间、由跑 agent 循环的
+    线程调用：工具线程直接 append 会撞上正在迭代 TOOLS 的请求序列化
+    （list changed size during iteration）。未开启 meta 工具时是空操作。
+    """
+    with _META_LOCK:
+        if _PENDING_META:
+            TOOLS.extend(_PENDING_META)
+            _PENDING_META.clear()
+
+
+def _record_tool_call(name: str) -> None:
+    """记录相邻工具对的出现次数，达标就装配融合工具。"""
+    global _META_DIRTY
+    with _META_LOCK:
+        if _LAST_TOOL:
+            pair = f"{_LAST_TOOL[0]}->{name}"
+            count = _META_STATS.get(pair, 0) + 1
+            _META_STATS[pair] = count
+            if count == META_FUSE_AT:
+                # 刚跨过融合阈值才值得立刻落盘；普通计数攒到退出时再写
+                _save_meta_stats()
+                _META_DIRTY = False
+            else:
+                _META_DIRTY = True
+        _LAST_TOOL[:] = [name]
+        _maybe_register_meta_tools()
+
+
+def _run_meta_tool(name: str, args: dict) -> str:
+    """meta_<t1>_then_<t2>：依次跑两个基础工具，拼接输出。"""
+    t1, _, t2 = name[len("meta_"):].partition("_then_")
+    out1 = execute_tool_sync(t1, args.get("first_args", {}))
+    out2 = execute_tool_sync(t2, args.get("second_args", {}))
+    return f"[{t1}]\n{out1}\n\n[{t2}]\n{out2}"
+
+
+# -----------------------------------------------------------------------------
+# 分发
+# -----------------------------------------------------------------------------
+
+# 同一轮里多个工具调用是并发跑的；写同一个文件必须串行，按路径加锁
+_PATH_LOCKS: dict[str, threading.Lock] = {}
+_PATH_LOCKS_GUARD = threading.Lock()
+
+
+def _path_lock(path: str) -> threading.Lock:
+    with _PATH_LOCKS_GUARD:
+        return _PATH_LOCKS.setdefault(path, threading.Lock())
+
+
+def execute_tool_sync(name: str, args: dict) -> str:
+    """
+    根据工具名分发到具体实现，并返回字符串结果。
+    读操作可随意并发；写/改操作按目标路径串行，避免并发写冲突。
+    """
+    if META_TOOLS_ENABLED:
+        if name.startswith("meta_") and "_then_" in name:
+            return _run_meta_tool(name, args)
+        _record_tool_call(name)
+    if name == "bash":
+        return run_bash(args["command"])
+    if name == "bash_batch":
+        return run_bash_batch(args["commands"])
+    if name == "read_file":
+        return run_read(args["path"], args.get("limit"))
+    if name == "write_file":
+        with _path_lock(args["path"]):
+            return run_write(args["path"], args["content"])
+    if name == "edit_file":
+        with _path_lock(args["path"]):
+            return run_edit(args["path"], args["old_text"], args["new_text"])
+    return f"Unknown tool: {name}"
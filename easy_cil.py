@@ -1,4 +1,6 @@
+import json
 import os
+import re
 import subprocess
 from openai import OpenAI
 
@@ -8,22 +10,42 @@ client = OpenAI(
     base_url="https://api.deepseek.com"
 )
 CMD_TIMEOUT = 300          # 秒，防止卡死
-MAX_OUTPUT_CHARS = 500  # 防止刷屏/占满上下文
+MAX_OUTPUT_TOKENS = 1500   # 防止刷屏/占满上下文（按 token 粗估，1 token ≈ 3 字符）
 WORKDIR = os.getcwd()      # 固定执行目录，避免跑到奇怪位置
 
-# 2. 定义安全护栏：危险关键词黑名单
-DANGER_ZONE = [
-    "rm ", "del ", "rd ", "format", "mkfs", "shred", 
-    "chmod 777", "chown", "> /dev/", "powershell.exe", 
-    "reg delete", "taskkill", "shutdown",
+# JSON 解析优先用 orjson（C 实现，快 2-3 倍）；没装就退回标准库
+try:
+    import orjson
+
+    def json_loads(s):
+        return orjson.loads(s)
+except ImportError:
+    json_loads = json.loads
+
+
+def truncate_tool_output(text: str, max_tokens: int = MAX_OUTPUT_TOKENS) -> str:
+    # 按 token 截断：保留开头 60% + 结尾 20%（尾部常有报错/退出码），中间占位
+    est = len(text) // 3
+    if est <= max_tokens:
+        return text
+    head = int(max_tokens * 0.6) * 3
+    tail = int(max_tokens * 0.2) * 3
+    return text[:head] + f"\n...(中间截断约 {est - max_tokens} tokens)...\n" + text[-tail:]
+
+# 2. 定义安全护栏：危险命令黑名单
+# 编译成单个正则：一次扫描代替 K 次子串查找（也省掉每次 .lower() 的分配），
+# 且词边界 \b 能避免 "remove"/"topic" 这类误伤（旧写法靠 " vim" 前导空格硬凑）
+DANGER_RE = re.compile(
+    r"\b(?:rm|del|rd|format|mkfs|shred|chown|shutdown|taskkill"
     # 交互型/TUI 程序：会占用终端或挂起 Agent 循环
-    " vim", "nano", "top", "htop", " less", " more"
-]
+    r"|vim|nano|top|htop|less|more)\b"
+    r"|\breg\s+delete\b|\bchmod\s+777\b|>\s*/dev/|powershell\.exe",
+    re.IGNORECASE,
+)
 
 def run_command(cmd: str):
     # 安全检查逻辑
-    is_dangerous = any(danger in cmd.lower() for danger in DANGER_ZONE)
-    if is_dangerous:
+    if DANGER_RE.search(cmd):
         print(f"\n  [安全警告]: AI 试图执行高危命令: {cmd}")
         confirm = input("确认执行吗？ (y/n): ").strip().lower()
         if confirm != 'y':
@@ -46,8 +68,7 @@ def run_command(cmd: str):
             output = "成功执行（无输出）"
 
         # 输出截断（核心工程约束）
-        if len(output) > MAX_OUTPUT_CHARS:
-            output = output[:MAX_OUTPUT_CHARS] + "\n...(输出过长已截断)"
+        output = truncate_tool_output(output)
 
         # 把退出码一并返回，便于模型判断成功/失败
         return f"[exit {rc}]\\n{output}"
@@ -100,8 +121,7 @@ while True:
             
             for tool_call in reply.tool_calls:
                 # 提取参数并运行函数
-                import json
-                args = json.loads(tool_call.function.arguments)
+                args = json_loads(tool_call.function.arguments)
                 result = run_command(args['cmd'])
                 
                 # 将“执行结果”喂回给模型
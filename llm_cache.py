@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+llm_cache.py - LLM 响应磁盘缓存
+
+开发迭代时经常用同样的历史重复调模型（改代码 -> 重跑同一个 prompt），
+每次都白付一趟网络往返。这里用 (model, messages, tools, temperature)
+的 SHA-256 做键，把已装配好的回复存到 .llm_cache/ 目录，命中时直接
+跳过网络。缓存只对确定性采样（temperature=0）成立，调用方应显式传
+temperature=0；非 0 温度的响应是随机样本，重放它们没有意义。
+
+- 键是确定性的：payload 经 sort_keys 的 JSON 序列化后取哈希。
+- 值用 pickle 存盘，默认 1 小时过期。
+- 设置环境变量 NO_LLM_CACHE=1 可整体关闭。
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import time
+from pathlib import Path
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+CACHE_DIR = Path(".llm_cache")
+DEFAULT_TTL = 3600  # 秒
+
+
+def enabled() -> bool:
+    return os.getenv("NO_LLM_CACHE") != "1"
+
+
+def cache_key(model: str, messages: list, tools: list, temperature: float = 0) -> str:
+    """对完整请求 payload 做确定性哈希，同样的输入必得同样的键。"""
+    payload = {
+        "model": model,
+        "messages": messages,
+        "tools": tools,
+        "temperature": temperature,
+    }
+    if orjson is not None:
+        # orjson 直接产出排好序的 bytes，长 messages 上比标准库快 2-3 倍
+        blob = orjson.dumps(payload, option=orjson.OPT_SORT_KEYS, default=str)
+    else:
+        blob = json.dumps(
+            payload, sort_keys=True, ensure_ascii=False, default=str
+        ).encode("utf-8")
+    return hashlib.sha256(blob).hexdigest()
+
+
+def cache_get(key: str):
+    """命中返回缓存值，未命中/已过期/读坏了都返回 None。"""
+    if not enabled():
+        return None
+    fp = CACHE_DIR / key
+    try:
+        expire_at, value = pickle.loads(fp.read_bytes())
+    except (OSError, pickle.PickleError, EOFError, ValueError):
+        return None
+    if time.time() > expire_at:
+        fp.unlink(missing_ok=True)
+        return None
+    return value
+
+
+def cache_set(key: str, value, ttl: int = DEFAULT_TTL) -> None:
+    """写缓存；磁盘问题不致命，静默放弃。"""
+    if not enabled():
+        return
+    try:
+        CACHE_DIR.mkdir(exist_ok=True)
+        (CACHE_DIR / key).write_bytes(pickle.dumps((time.time() + ttl, value)))
+    except OSError:
+        pass
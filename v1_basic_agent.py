@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
-v1_basic_agent.py - 极简 Claude Code 思路演示（约 200 行）
+v1_basic_agent.py - 极简 Claude Code 思路演示
 
 核心理念：“模型自己就是 Agent”
 =============================
@@ -18,267 +18,318 @@ Agent 模式：
 
 重点：决策者是模型。代码只负责把“工具箱 + 循环”摆好。
 
-四个核心工具（覆盖 90% 编程场景）
+核心工具（覆盖 90% 编程场景）
 -------------------------------
 | 工具       | 用途            | 示例                     |
 |------------|-----------------|--------------------------|
 | bash       | 跑任意命令      | npm install, git status  |
+| bash_batch | 批量跑命令      | 一次提交整串命令         |
 | read_file  | 读文件内容      | 查看 src/index.ts        |
 | write_file | 创建/覆盖文件   | 写 README.md             |
 | edit_file  | 局部替换        | 修改某个函数             |
 
+工具实现与 TOOLS 定义在 agent_core.py（v1/v2 共用）。
+
 运行方式：
     python v1_basic_agent.py
 """
 
-import os
-import subprocess
-import sys
-from pathlib import Path
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from openai import (
+    APIConnectionError,
+    APITimeoutError,
+    InternalServerError,
+    OpenAI,
+    RateLimitError,
+)
+
+import llm_cache
+from agent_core import (
+    COMPRESS_AT,
+    FORWARD_BUFFER,
+    KEEP_RECENT,
+    P_HIST,
+    SYSTEM_TEMPLATE,
+    TOOLS,
+    WORKDIR,
+    apply_pending_meta_tools,
+    estimate_tokens,
+    execute_tool_sync as execute_tool,
+    json_loads,
+)
 
-from openai import OpenAI
 
+def _make_http_client() -> httpx.Client:
+    """
+    显式配置的 httpx 客户端：keep-alive 连接池 + HTTP/2，
+    避免每次 create() 都重新握手 TLS（热路径上省 ~100ms）。
+    缺 h2 包时自动退回 HTTP/1.1。
+    """
+    kwargs = dict(
+        limits=httpx.Limits(
+            max_keepalive_connections=32,
+            max_connections=64,
+            keepalive_expiry=60.0,
+        ),
+        timeout=httpx.Timeout(60.0, connect=5.0),
+    )
+    try:
+        return httpx.Client(http2=True, **kwargs)
+    except ImportError:
+        return httpx.Client(**kwargs)
 
 
-# 工作目录固定为当前目录，避免越界
-WORKDIR = Path.cwd()
 # 创建客户端（OpenAI 兼容接口指向 DeepSeek）
 client = OpenAI(
     api_key='',
-    base_url="https://api.deepseek.com/v1"
+    base_url="https://api.deepseek.com/v1",
+    http_client=_make_http_client(),
 )
-# -----------------------------------------------------------------------------
-# 系统提示词（给模型的唯一“规则”）
-# -----------------------------------------------------------------------------
 
-SYSTEM = f"""你是一名在目录 {WORKDIR} 里的编码 Agent。
+# “再试一次大概率就好”的瞬时错误；业务性 4xx 错误照常直接抛
+RETRYABLE_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+MAX_RETRIES = 5
 
-循环：先简短思考 -> 调用工具 -> 汇报结果。
+# 主工具循环固定贪心解码：响应缓存的前提是同样输入必得同样输出，
+# 不显式传的话 DeepSeek 默认 temperature=1.0（随机采样），缓存就变成重放随机数
+TEMPERATURE = 0
 
-规则：
-- 多用工具，少空谈；能动手就别光解释。
-- 不要凭空猜文件路径，不确定就先 ls/find。
-- 修改要最小化，不要过度设计。
-- 完成后简述改动内容。"""
 
-# -----------------------------------------------------------------------------
-# 工具定义（告诉模型有哪些工具可用）
-# -----------------------------------------------------------------------------
-
-TOOLS = [
-    {
-        "type": "function",
-        "function": {
-            "name": "bash",
-            "description": "执行任意 Shell 命令，如 ls、find、grep、git、npm、python 等。",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "command": {"type": "string", "description": "要运行的 shell 命令"}
-                },
-                "required": ["command"],
-            },
-        },
-    },
-    {
-        "type": "function",
-        "function": {
-            "name": "read_file",
-            "description": "读取文件内容（UTF-8）。可选 limit 只读前 N 行。",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "path": {"type": "string", "description": "相对路径"},
-                    "limit": {"type": "integer", "description": "最多读取的行数"},
-                },
-                "required": ["path"],
-            },
-        },
-    },
-    {
-        "type": "function",
-        "function": {
-            "name": "write_file",
-            "description": "写入文件（创建或覆盖），自动创建父目录。",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "path": {"type": "string", "description": "相对路径"},
-                    "content": {"type": "string", "description": "写入的全文内容"},
-                },
-                "required": ["path", "content"],
-            },
-        },
-    },
-    {
-        "type": "function",
-        "function": {
-            "name": "edit_file",
-            "description": "对文件做精确替换：用 new_text 替换第一次出现的 old_text。",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "path": {"type": "string", "description": "相对路径"},
-                    "old_text": {"type": "string", "description": "待替换的原文（需精确匹配）"},
-                    "new_text": {"type": "string", "description": "替换后的文本"},
-                },
-                "required": ["path", "old_text", "new_text"],
-            },
-        },
-    },
-]
-
-# -----------------------------------------------------------------------------
-# 工具实现
-# -----------------------------------------------------------------------------
-
-def safe_path(p: str) -> Path:
+def _llm_call(**kwargs):
     """
-    确保路径留在工作区内，防止通过 ../ 越界访问。
+    带指数退避的 create()：429/超时/连接断/5xx 最多重试 5 次，
+    0.5s 起步翻倍到 8s 封顶，外加随机抖动避免同步雪崩。
+    不重试的话，一次瞬时抖动就浪费一整轮昂贵的模型调用。
     """
-    path = (WORKDIR / p).resolve()
-    if not path.is_relative_to(WORKDIR):
-        raise ValueError(f"路径越界：{p}")
-    return path
+    delay = 0.5
+    for attempt in range(MAX_RETRIES):
+        try:
+            return client.chat.completions.create(**kwargs)
+        except RETRYABLE_ERRORS:
+            if attempt == MAX_RETRIES - 1:
+                raise
+            time.sleep(delay + random.uniform(0, delay))
+            delay = min(delay * 2, 8.0)
 
 
-def run_bash(command: str) -> str:
-    """
-    执行 shell 命令，附带简单安全限制与超时。
-    - 拦截明显危险的模式。
-    - 超时 60 秒。
-    - 输出截断到 50KB，避免撑爆上下文。
-    """
-    dangerous = ["rm -rf /", "sudo", "shutdown", "reboot", "> /dev/"]
-    if any(d in command for d in dangerous):
-        return "Error: 危险命令已拦截"
+# -----------------------------------------------------------------------------
+# 系统提示词（给模型的唯一“规则”）
+# -----------------------------------------------------------------------------
 
-    try:
-        result = subprocess.run(
-            command,
-            shell=True,
-            cwd=WORKDIR,
-            capture_output=True,
-            text=True,
-            timeout=60,
-        )
-        output = (result.stdout + result.stderr).strip()
-        return output[:50000] if output else "(no output)"
-    except subprocess.TimeoutExpired:
-        return "Error: 命令超时 (60s)"
-    except Exception as e:
-        return f"Error: {e}"
+SYSTEM = SYSTEM_TEMPLATE.format(
+    workdir=WORKDIR,
+    mode_rules="""循环：先简短思考 -> 调用工具 -> 汇报结果。
 
+- 多用工具，少空谈；能动手就别光解释。
+- 完成后简述改动内容。""",
+)
 
-def run_read(path: str, limit: int | None = None) -> str:
-    """
-    读取文件，可指定 limit 仅返回前 N 行；输出截断 50KB。
-    """
-    try:
-        text = safe_path(path).read_text()
-        lines = text.splitlines()
-        if limit and limit < len(lines):
-            lines = lines[:limit] + [f"... (还有 {len(text.splitlines()) - limit} 行)"]
-        return "\n".join(lines)[:50000]
-    except Exception as e:
-        return f"Error: {e}"
+# -----------------------------------------------------------------------------
+# 历史压缩（防止长会话 token 无限膨胀）
+# -----------------------------------------------------------------------------
 
 
-def run_write(path: str, content: str) -> str:
-    """
-    写文件（创建或覆盖），会自动建父目录。
-    """
+def summarize_history(prefix: list) -> str | None:
+    """调一次便宜的摘要请求，把旧轮次折叠成一段文字；失败返回 None。"""
+    transcript = "\n".join(
+        f"[{m.get('role')}] {str(m.get('content') or '')[:2000]}" for m in prefix
+    )
     try:
-        fp = safe_path(path)
-        fp.parent.mkdir(parents=True, exist_ok=True)
-        fp.write_text(content)
-        return f"Wrote {len(content)} bytes to {path}"
-    except Exception as e:
-        return f"Error: {e}"
+        resp = _llm_call(
+            model="deepseek-chat",
+            messages=[
+                {"role": "system", "content": P_HIST},
+                {"role": "user", "content": transcript},
+            ],
+            max_tokens=512,
+        )
+        return resp.choices[0].message.content or None
+    except Exception:
+        return None
 
 
-def run_edit(path: str, old_text: str, new_text: str) -> str:
-    """
-    精确替换文件中的第一处 old_text，避免大面积误替换。
+def maybe_compress(messages: list, last_prompt_tokens: int = 0) -> list:
     """
-    try:
-        fp = safe_path(path)
-        content = fp.read_text()
-        if old_text not in content:
-            return f"Error: 未找到要替换的内容 ({path})"
-        new_content = content.replace(old_text, new_text, 1)
-        fp.write_text(new_content)
-        return f"Edited {path}"
-    except Exception as e:
-        return f"Error: {e}"
-
-
-def execute_tool(name: str, args: dict) -> str:
-    """
-    根据工具名分发到具体实现，并返回字符串结果。
+    历史超过阈值时压缩：
+    - 以最近一条 user 消息为分界（pivot），pivot 及其后的工具往返原样保留；
+    - 单任务的长工具循环里唯一的 user 消息在开头、pivot 前没东西可折，
+      这时退一步按“保留最近 KEEP_RECENT 条”选切点；
+    - pivot 之前的内容（system 除外）折叠成一条摘要 assistant 消息。
+    未超阈值或压缩失败时原样返回。
+
+    体量计量优先用上一轮 API 返回的 usage.prompt_tokens（一个整数，O(1)），
+    拿不到（首轮）才退回逐条字符粗估。
     """
-    if name == "bash":
-        return run_bash(args["command"])
-    if name == "read_file":
-        return run_read(args["path"], args.get("limit"))
-    if name == "write_file":
-        return run_write(args["path"], args["content"])
-    if name == "edit_file":
-        return run_edit(args["path"], args["old_text"], args["new_text"])
-    return f"Unknown tool: {name}"
+    if last_prompt_tokens:
+        used = last_prompt_tokens + FORWARD_BUFFER
+    else:
+        used = estimate_tokens(messages)
+    if used < COMPRESS_AT:
+        return messages
+
+    pivot = None
+    for i in range(len(messages) - 1, -1, -1):
+        if messages[i].get("role") == "user":
+            pivot = i
+            break
+    if pivot is None or pivot <= 1:
+        # user 前缀为空（工具循环把历史撑大了），改为保留最近几条
+        pivot = len(messages) - KEEP_RECENT
+        # 切点不能落在 tool 消息上，否则会和它的 assistant tool_calls 拆散
+        while pivot > 1 and messages[pivot].get("role") == "tool":
+            pivot -= 1
+        if pivot <= 1:
+            return messages  # 历史还不够长，没什么可折叠的
+
+    head = [m for m in messages[:pivot] if m.get("role") == "system"]
+    prefix = [m for m in messages[:pivot] if m.get("role") != "system"]
+    summary = summarize_history(prefix)
+    if not summary:
+        return messages
+    return head + [
+        {"role": "assistant", "content": f"（此前历史已压缩）{summary}"}
+    ] + messages[pivot:]
 
 
 # -----------------------------------------------------------------------------
 # 核心 Agent 循环
 # -----------------------------------------------------------------------------
 
+# 工具执行线程池：流式响应一边收 token，一边提前派发已凑齐的工具调用
+EXECUTOR = ThreadPoolExecutor(max_workers=8)
+
+
 def agent_loop(messages: list) -> list:
     """
     完整的 Agent 循环：
-        1) 调模型
-        2) 若模型要用工具，则执行并把结果塞回对话
+        1) 流式调模型，边收边解析 tool_calls
+        2) 某个工具调用的参数一旦凑成完整 JSON，立刻丢进线程池执行，
+           让“模型继续吐 token”和“工具跑起来”重叠，省掉一段尾延迟
         3) 没有工具调用就返回（任务结束）
     """
+    last_prompt_tokens = 0  # 上一轮 API 报告的精确 prompt token 数
     while True:
-        # 1. 让模型思考/决策
-        response = client.chat.completions.create(
-            model="deepseek-chat",
-            messages=messages,
-            tools=TOOLS,
-            tool_choice="auto",
-        )
-
-        reply = response.choices[0].message
+        # 轮间并入上一轮攒出的融合工具（工具线程不能直接改 TOOLS）
+        apply_pending_meta_tools()
+
+        # 历史过长时先压缩（原地替换，调用方持有的 history 同步生效）
+        compressed = maybe_compress(messages, last_prompt_tokens)
+        if compressed is not messages:
+            last_prompt_tokens = 0  # 压缩后旧计数作废，等下一轮 usage 刷新
+            messages[:] = compressed
+
+        # 1. 让模型思考/决策。先查缓存：同样的 (model, messages, tools)
+        #    直接复用上次装配好的回复，整趟网络往返变成一次磁盘读。
+        key = llm_cache.cache_key("deepseek-chat", messages, TOOLS, TEMPERATURE)
+        calls: dict[int, dict] = {}        # index -> {"id", "name", "args"}
+        futures: dict[int, object] = {}    # index -> 已派发的 Future
+        dispatched: dict[tuple, object] = {}  # (name, args串) -> Future，同参调用去重
+
+        cached = llm_cache.cache_get(key)
+        if cached is not None:
+            print("\n[LLM 缓存命中，跳过网络请求]")
+            content, calls = cached
+        else:
+            stream = _llm_call(
+                model="deepseek-chat",
+                messages=messages,
+                tools=TOOLS,
+                tool_choice="auto",
+                temperature=TEMPERATURE,
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+
+            content_parts: list[str] = []
+            for chunk in stream:
+                # usage 在流的最后一个 chunk 上，顺手记下精确计数
+                if chunk.usage:
+                    last_prompt_tokens = chunk.usage.prompt_tokens
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                if delta.content:
+                    content_parts.append(delta.content)
+                for tc in delta.tool_calls or []:
+                    call = calls.setdefault(tc.index, {"id": "", "name": "", "args": ""})
+                    if tc.id:
+                        call["id"] = tc.id
+                    if tc.function:
+                        if tc.function.name:
+                            call["name"] += tc.function.name
+                        if tc.function.arguments:
+                            call["args"] += tc.function.arguments
+                    # 参数片段拼成合法 JSON 即视为完整，提前开跑。
+                    # 注意必须等到有参数片段：首个 delta 往往只带工具名、
+                    # 参数还是空串，这时不能按 {} 抢跑（真参数在后面的 chunk 里）。
+                    # 真正无参数的调用留给流结束后的兜底循环处理。
+                    if tc.index not in futures and call["name"] and call["args"]:
+                        try:
+                            args = json_loads(call["args"])
+                        except ValueError:
+                            continue
+                        dkey = (call["name"], call["args"])
+                        if dkey in dispatched:
+                            # 同名同参的重复调用：复用第一次的结果，不再跑一遍
+                            futures[tc.index] = dispatched[dkey]
+                        else:
+                            print(f"\n> {call['name']}: {args}")
+                            dispatched[dkey] = EXECUTOR.submit(execute_tool, call["name"], args)
+                            futures[tc.index] = dispatched[dkey]
+
+            content = "".join(content_parts)
+            llm_cache.cache_set(key, (content, calls))
 
         # 2. 没有工具调用，任务完成
-        if not reply.tool_calls:
-            print(reply.content)
+        if not calls:
+            print(content)
             messages.append({
                 "role": "assistant",
-                "content": reply.content or ""
+                "content": content
             })
             return messages
 
-        # 3. 执行工具并收集结果
+        # 兜底：还没派发的（缓存命中或空参数）统一补上
+        for idx, call in calls.items():
+            if idx not in futures:
+                dkey = (call["name"], call["args"])
+                if dkey in dispatched:
+                    futures[idx] = dispatched[dkey]
+                    continue
+                args = json_loads(call["args"] or "{}")
+                print(f"\n> {call['name']}: {args}")
+                dispatched[dkey] = EXECUTOR.submit(execute_tool, call["name"], args)
+                futures[idx] = dispatched[dkey]
+
+        # 3. 按原始顺序收集结果，保证 tool 消息与 tool_call_id 对齐
         results = []
-        import json
-        for tc in reply.tool_calls:
-            args = json.loads(tc.function.arguments)
-            print(f"\n> {tc.function.name}: {args}")
-            output = execute_tool(tc.function.name, args)
+        for idx in sorted(calls):
+            call = calls[idx]
+            output = futures[idx].result()
             preview = output[:200] + "..." if len(output) > 200 else output
             print(f"  {preview}")
             results.append({
                 "role": "tool",
-                "tool_call_id": tc.id,
+                "tool_call_id": call["id"],
                 "content": output,
             })
 
         # 4. 把模型回复和工具结果加入历史，继续循环
         messages.append({
             "role": "assistant",
-            "content": reply.content or "",
-            "tool_calls": reply.tool_calls,
+            "content": content,
+            "tool_calls": [
+                {
+                    "id": calls[idx]["id"],
+                    "type": "function",
+                    "function": {"name": calls[idx]["name"], "arguments": calls[idx]["args"]},
+                }
+                for idx in sorted(calls)
+            ],
         })
         messages.extend(results)
 
@@ -294,7 +345,9 @@ def main():
     print(f"Mini Claude Code v1 - {WORKDIR}")
     print("输入 exit / quit 可退出。\n")
 
-    history = []
+    # 系统提示词必须真的进历史，否则工作目录、bash_batch 偏好等规则
+    # 一条都到不了模型
+    history = [{"role": "system", "content": SYSTEM}]
 
     while True:
         try:
@@ -7,219 +7,367 @@ v2_async_agent.py - 异步版 Agent（step 状态机 + 任务解耦）
 - 请求只负责“投递任务”
 - Agent 在后台按 step 运行，每步显式让出控制权
 - 通过 task_id 查询状态（非阻塞）
+
+工具实现与 TOOLS 定义在 agent_core.py（v1/v2 共用）。
 """
 
 import asyncio
 import os
-import subprocess
-import sys
+import random
 import uuid
-from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from openai import (
+    APIConnectionError,
+    APITimeoutError,
+    AsyncOpenAI,
+    InternalServerError,
+    RateLimitError,
+)
+
+import llm_cache
+from agent_core import (
+    COMPRESS_AT,
+    FORWARD_BUFFER,
+    KEEP_RECENT,
+    P_HIST,
+    SYSTEM_TEMPLATE,
+    TOOLS,
+    WORKDIR,
+    apply_pending_meta_tools,
+    execute_tool_sync,
+    json_loads,
+)
+
 
-from openai import AsyncOpenAI
+def _make_http_client() -> httpx.AsyncClient:
+    """
+    显式配置的 httpx 客户端：keep-alive 连接池 + HTTP/2，
+    避免每次 create() 都重新握手 TLS，并允许并发请求复用同一连接。
+    缺 h2 包时自动退回 HTTP/1.1。
+    """
+    kwargs = dict(
+        limits=httpx.Limits(
+            max_keepalive_connections=32,
+            max_connections=64,
+            keepalive_expiry=60.0,
+        ),
+        timeout=httpx.Timeout(60.0, connect=5.0),
+    )
+    try:
+        return httpx.AsyncClient(http2=True, **kwargs)
+    except ImportError:
+        return httpx.AsyncClient(**kwargs)
 
-# 工作目录固定为当前目录，避免越界
-WORKDIR = Path.cwd()
 
 # 创建客户端（OpenAI 兼容接口指向 DeepSeek）
 client = AsyncOpenAI(
     api_key=os.getenv("DEEPSEEK_API_KEY", ""),
     base_url="https://api.deepseek.com/v1",
+    http_client=_make_http_client(),
 )
 
-SYSTEM = f"""你是一名在目录 {WORKDIR} 里的编码 Agent。
-
-异步规则：
+# “再试一次大概率就好”的瞬时错误；业务性 4xx 错误照常直接抛
+RETRYABLE_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+MAX_RETRIES = 5
+
+# 主工具循环固定贪心解码：响应缓存的前提是同样输入必得同样输出，
+# 不显式传的话 DeepSeek 默认 temperature=1.0（随机采样），缓存就变成重放随机数
+TEMPERATURE = 0
+
+
+async def _llm_call(**kwargs):
+    """
+    带指数退避的 create()：429/超时/连接断/5xx 最多重试 5 次，
+    0.5s 起步翻倍到 8s 封顶，外加随机抖动避免同步雪崩。
+    v2 的 agent_loop 跑在后台任务里，不重试的话一次抖动就整轮报废。
+    """
+    delay = 0.5
+    for attempt in range(MAX_RETRIES):
+        try:
+            return await client.chat.completions.create(**kwargs)
+        except RETRYABLE_ERRORS:
+            if attempt == MAX_RETRIES - 1:
+                raise
+            await asyncio.sleep(delay + random.uniform(0, delay))
+            delay = min(delay * 2, 8.0)
+
+
+SYSTEM = SYSTEM_TEMPLATE.format(
+    workdir=WORKDIR,
+    mode_rules="""异步规则：
 - 每次 step 只做有限工作；需要工具时只执行一次工具调用然后返回。
-- 每步结束必须让出控制权（由外层 loop 统一 await/yield）。
-- 不要猜路径，不确定就先 ls/find。
-- 修改要最小化，不要过度设计。"""
-
-TOOLS = [
-    {
-        "type": "function",
-        "function": {
-            "name": "bash",
-            "description": "执行任意 Shell 命令，如 ls、find、grep、git、npm、python 等。",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "command": {"type": "string", "description": "要运行的 shell 命令"}
-                },
-                "required": ["command"],
-            },
-        },
-    },
-    {
-        "type": "function",
-        "function": {
-            "name": "read_file",
-            "description": "读取文件内容（UTF-8）。可选 limit 只读前 N 行。",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "path": {"type": "string", "description": "相对路径"},
-                    "limit": {"type": "integer", "description": "最多读取的行数"},
-                },
-                "required": ["path"],
-            },
-        },
-    },
-    {
-        "type": "function",
-        "function": {
-            "name": "write_file",
-            "description": "写入文件（创建或覆盖），自动创建父目录。",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "path": {"type": "string", "description": "相对路径"},
-                    "content": {"type": "string", "description": "写入的全文内容"},
-                },
-                "required": ["path", "content"],
-            },
-        },
-    },
-    {
-        "type": "function",
-        "function": {
-            "name": "edit_file",
-            "description": "对文件做精确替换：用 new_text 替换第一次出现的 old_text。",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "path": {"type": "string", "description": "相对路径"},
-                    "old_text": {"type": "string", "description": "待替换的原文（需精确匹配）"},
-                    "new_text": {"type": "string", "description": "替换后的文本"},
-                },
-                "required": ["path", "old_text", "new_text"],
-            },
-        },
-    },
-]
-
-
-def safe_path(p: str) -> Path:
-    path = (WORKDIR / p).resolve()
-    if not path.is_relative_to(WORKDIR):
-        raise ValueError(f"路径越界：{p}")
-    return path
-
-
-def run_bash(command: str) -> str:
-    dangerous = ["rm -rf /", "sudo", "shutdown", "reboot", "> /dev/"]
-    if any(d in command for d in dangerous):
-        return "Error: 危险命令已拦截"
-
-    try:
-        result = subprocess.run(
-            command,
-            shell=True,
-            cwd=WORKDIR,
-            capture_output=True,
-            text=True,
-            timeout=60,
-        )
-        output = (result.stdout + result.stderr).strip()
-        return output[:50000] if output else "(no output)"
-    except subprocess.TimeoutExpired:
-        return "Error: 命令超时 (60s)"
-    except Exception as e:
-        return f"Error: {e}"
-
-
-def run_read(path: str, limit: int | None = None) -> str:
-    try:
-        text = safe_path(path).read_text()
-        lines = text.splitlines()
-        if limit and limit < len(lines):
-            lines = lines[:limit] + [f"... (还有 {len(text.splitlines()) - limit} 行)"]
-        return "\n".join(lines)[:50000]
-    except Exception as e:
-        return f"Error: {e}"
+- 每步结束必须让出控制权（由外层 loop 统一 await/yield）。""",
+)
 
 
-def run_write(path: str, content: str) -> str:
-    try:
-        fp = safe_path(path)
-        fp.parent.mkdir(parents=True, exist_ok=True)
-        fp.write_text(content)
-        return f"Wrote {len(content)} bytes to {path}"
-    except Exception as e:
-        return f"Error: {e}"
-
+class MessageStore:
+    """
+    SoA（列数组）存放消息历史：roles / contents / tool_calls_blob /
+    tool_call_ids 各一条平行数组，外加 msg_tokens 记每条消息的 token 粗估。
+
+    好处：
+    - 找 pivot、算历史 token 质量只需扫 roles 和整型数组，不碰内容字符串；
+    - 压缩折叠是数组切片拼接；
+    - to_openai_messages() 每轮只在发请求前拼一次 dict 列表。
+    """
+
+    def __init__(self):
+        self.roles: list[str] = []
+        self.contents: list[str] = []
+        self.tool_calls_blob: list[list | None] = []
+        self.tool_call_ids: list[str | None] = []
+        self.msg_tokens: list[int] = []
+
+    def __len__(self) -> int:
+        return len(self.roles)
+
+    def append(self, role: str, content: str,
+               tool_calls: list | None = None,
+               tool_call_id: str | None = None) -> None:
+        self.roles.append(role)
+        self.contents.append(content or "")
+        self.tool_calls_blob.append(tool_calls)
+        self.tool_call_ids.append(tool_call_id)
+        # 与 estimate_tokens 同一口径：1 token ≈ 3 字符 + 每条固定开销
+        self.msg_tokens.append(len(content or "") // 3 + 8)
+
+    def total_tokens(self) -> int:
+        return sum(self.msg_tokens)
+
+    def last_user_index(self) -> int | None:
+        for i in range(len(self.roles) - 1, -1, -1):
+            if self.roles[i] == "user":
+                return i
+        return None
+
+    def transcript_before(self, pivot: int) -> str:
+        """pivot 之前（system 除外）的对话拼成摘要器输入。"""
+        return "\n".join(
+            f"[{self.roles[i]}] {self.contents[i][:2000]}"
+            for i in range(pivot)
+            if self.roles[i] != "system"
+        )
 
-def run_edit(path: str, old_text: str, new_text: str) -> str:
+    def compress_prefix(self, pivot: int, summary: str) -> None:
+        """把 pivot 之前的行折叠成一条摘要 assistant 行（system 行保留在最前）。"""
+        keep = [i for i in range(pivot) if self.roles[i] == "system"]
+        keep_tail = list(range(pivot, len(self.roles)))
+
+        def _rebuild(col: list, summary_value) -> list:
+            return [col[i] for i in keep] + [summary_value] + [col[i] for i in keep_tail]
+
+        summary_text = f"（此前历史已压缩）{summary}"
+        self.roles = _rebuild(self.roles, "assistant")
+        self.contents = _rebuild(self.contents, summary_text)
+        self.tool_calls_blob = _rebuild(self.tool_calls_blob, None)
+        self.tool_call_ids = _rebuild(self.tool_call_ids, None)
+        self.msg_tokens = _rebuild(self.msg_tokens, len(summary_text) // 3 + 8)
+
+    def to_openai_messages(self) -> list[dict]:
+        out = []
+        for role, content, blob, cid in zip(
+            self.roles, self.contents, self.tool_calls_blob, self.tool_call_ids
+        ):
+            m = {"role": role, "content": content}
+            if blob:
+                m["tool_calls"] = blob
+            if cid:
+                m["tool_call_id"] = cid
+            out.append(m)
+        return out
+
+
+async def summarize_history(transcript: str) -> str | None:
+    """调一次便宜的摘要请求，把旧轮次折叠成一段文字；失败返回 None。"""
     try:
-        fp = safe_path(path)
-        content = fp.read_text()
-        if old_text not in content:
-            return f"Error: 未找到要替换的内容 ({path})"
-        new_content = content.replace(old_text, new_text, 1)
-        fp.write_text(new_content)
-        return f"Edited {path}"
-    except Exception as e:
-        return f"Error: {e}"
+        resp = await _llm_call(
+            model=os.getenv("DEEPSEEK_MODEL", "deepseek-chat"),
+            messages=[
+                {"role": "system", "content": P_HIST},
+                {"role": "user", "content": transcript},
+            ],
+            max_tokens=512,
+        )
+        return resp.choices[0].message.content or None
+    except Exception:
+        return None
+
+
+async def maybe_compress(store: MessageStore, last_prompt_tokens: int = 0) -> bool:
+    """
+    历史超过阈值时原地压缩 store，发生了压缩返回 True：
+    - 以最近一条 user 消息为分界（pivot），pivot 及其后的工具往返原样保留；
+    - 每个任务只有开头一条 user 消息、pivot 前没东西可折，
+      这时退一步按“保留最近 KEEP_RECENT 条”选切点；
+    - pivot 之前的内容（system 除外）折叠成一条摘要 assistant 行。
+
+    体量计量优先用上一轮 API 返回的 usage.prompt_tokens（O(1)），
+    拿不到（首轮）才退回 msg_tokens 求和——SoA 下只是整型加法，
+    不碰任何内容字符串。
+    """
+    if last_prompt_tokens:
+        used = last_prompt_tokens + FORWARD_BUFFER
+    else:
+        used = store.total_tokens()
+    if used < COMPRESS_AT:
+        return False
+
+    pivot = store.last_user_index()
+    if pivot is None or pivot <= 1:
+        # user 前缀为空（工具循环把历史撑大了），改为保留最近几条
+        pivot = len(store) - KEEP_RECENT
+        # 切点不能落在 tool 行上，否则会和它的 assistant tool_calls 拆散
+        while pivot > 1 and store.roles[pivot] == "tool":
+            pivot -= 1
+        if pivot <= 1:
+            return False  # 历史还不够长，没什么可折叠的
+
+    summary = await summarize_history(store.transcript_before(pivot))
+    if not summary:
+        return False
+    store.compress_prefix(pivot, summary)
+    return True
+
+
+# 工具专用的有界线程池：asyncio.to_thread 走默认执行器（线程数不固定，
+# 且每次调用带 contextvars 拷贝开销），固定 16 线程让并发文件 I/O 的
+# p99 延迟更稳，也防止大量任务把线程数打爆
+TOOL_EXECUTOR = ThreadPoolExecutor(max_workers=16, thread_name_prefix="tool")
+
+
+async def _in_executor(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(TOOL_EXECUTOR, fn, *args)
 
 
 async def execute_tool(name: str, args: dict) -> str:
-    if name == "bash":
-        return await asyncio.to_thread(run_bash, args["command"])
-    if name == "read_file":
-        return await asyncio.to_thread(run_read, args["path"], args.get("limit"))
-    if name == "write_file":
-        return await asyncio.to_thread(run_write, args["path"], args["content"])
-    if name == "edit_file":
-        return await asyncio.to_thread(run_edit, args["path"], args["old_text"], args["new_text"])
-    return f"Unknown tool: {name}"
+    """丢进线程池执行；同路径写冲突的串行化在 agent_core 里按路径加锁。"""
+    return await _in_executor(execute_tool_sync, name, args)
 
 
 class AsyncAgent:
     def __init__(self, user_prompt: str):
         self.done = False
+        self.last_prompt_tokens = 0  # 上一轮 API 报告的精确 prompt token 数
         self.state = {"status": "running", "step": 0, "answer": ""}
-        self.messages = [
-            {"role": "system", "content": SYSTEM},
-            {"role": "user", "content": user_prompt},
-        ]
+        self.messages = MessageStore()
+        self.messages.append("system", SYSTEM)
+        self.messages.append("user", user_prompt)
 
     async def step(self):
-        """单步执行：一次模型调用 + （可选）一次工具调用。"""
-        self.state["step"] += 1
+        """单步执行：一次流式模型调用 + （可选）工具调用。
 
-        response = await client.chat.completions.create(
-            model=os.getenv("DEEPSEEK_MODEL", "deepseek-chat"),
-            messages=self.messages,
-            tools=TOOLS,
-            tool_choice="auto",
-        )
+        流式的好处：tool_call 参数一旦凑成完整 JSON，立刻 create_task
+        开跑，让模型剩余 token 的生成和工具执行重叠。
+        """
+        self.state["step"] += 1
 
-        reply = response.choices[0].message
+        # 轮间并入上一轮攒出的融合工具（工具线程不能直接改 TOOLS）
+        apply_pending_meta_tools()
+
+        # 历史过长时先压缩
+        if await maybe_compress(self.messages, self.last_prompt_tokens):
+            self.last_prompt_tokens = 0  # 压缩后旧计数作废，等下一轮 usage 刷新
+
+        # 每轮只把 SoA 拼一次 dict 列表，缓存键和 API 请求共用同一份
+        model = os.getenv("DEEPSEEK_MODEL", "deepseek-chat")
+        openai_messages = self.messages.to_openai_messages()
+        key = llm_cache.cache_key(model, openai_messages, TOOLS, TEMPERATURE)
+        calls: dict[int, dict] = {}                 # index -> {"id", "name", "args"}
+        tasks: dict[int, asyncio.Task] = {}         # index -> 已派发的工具任务
+        dispatched: dict[tuple, asyncio.Task] = {}  # (name, args串) -> Task，同参调用去重
+
+        cached = llm_cache.cache_get(key)
+        if cached is not None:
+            content, calls = cached
+        else:
+            stream = await _llm_call(
+                model=model,
+                messages=openai_messages,
+                tools=TOOLS,
+                tool_choice="auto",
+                temperature=TEMPERATURE,
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+
+            content_parts: list[str] = []
+            async for chunk in stream:
+                # usage 在流的最后一个 chunk 上，顺手记下精确计数
+                if chunk.usage:
+                    self.last_prompt_tokens = chunk.usage.prompt_tokens
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                if delta.content:
+                    content_parts.append(delta.content)
+                for tc in delta.tool_calls or []:
+                    call = calls.setdefault(tc.index, {"id": "", "name": "", "args": ""})
+                    if tc.id:
+                        call["id"] = tc.id
+                    if tc.function:
+                        if tc.function.name:
+                            call["name"] += tc.function.name
+                        if tc.function.arguments:
+                            call["args"] += tc.function.arguments
+                    # 参数片段拼成合法 JSON 即视为完整，提前开跑。
+                    # 注意必须等到有参数片段：首个 delta 往往只带工具名、
+                    # 参数还是空串，这时不能按 {} 抢跑（真参数在后面的 chunk 里）。
+                    # 真正无参数的调用留给流结束后的兜底循环处理。
+                    if tc.index not in tasks and call["name"] and call["args"]:
+                        try:
+                            args = json_loads(call["args"])
+                        except ValueError:
+                            continue
+                        dkey = (call["name"], call["args"])
+                        if dkey not in dispatched:
+                            # 同名同参的重复调用只真正跑第一次
+                            dispatched[dkey] = asyncio.create_task(
+                                execute_tool(call["name"], args)
+                            )
+                        tasks[tc.index] = dispatched[dkey]
+
+            content = "".join(content_parts)
+            llm_cache.cache_set(key, (content, calls))
 
         # 没有工具调用 => 结束
-        if not reply.tool_calls:
+        if not calls:
             self.state["status"] = "finished"
-            self.state["answer"] = reply.content or ""
+            self.state["answer"] = content
             self.done = True
-            self.messages.append({"role": "assistant", "content": reply.content or ""})
+            self.messages.append("assistant", content)
             return
 
-        # 有工具调用：执行一次并回填
-        self.messages.append({
-            "role": "assistant",
-            "content": reply.content or "",
-            "tool_calls": reply.tool_calls,
-        })
+        # 兜底：还没派发的（缓存命中或空参数）统一补上
+        for idx, call in calls.items():
+            if idx not in tasks:
+                dkey = (call["name"], call["args"])
+                if dkey not in dispatched:
+                    args = json_loads(call["args"] or "{}")
+                    dispatched[dkey] = asyncio.create_task(
+                        execute_tool(call["name"], args)
+                    )
+                tasks[idx] = dispatched[dkey]
+
+        # 有工具调用：执行并按原始顺序回填
+        self.messages.append(
+            "assistant",
+            content,
+            tool_calls=[
+                {
+                    "id": calls[idx]["id"],
+                    "type": "function",
+                    "function": {"name": calls[idx]["name"], "arguments": calls[idx]["args"]},
+                }
+                for idx in sorted(calls)
+            ],
+        )
 
-        import json
-        for tc in reply.tool_calls:
-            args = json.loads(tc.function.arguments)
-            output = await execute_tool(tc.function.name, args)
-            self.messages.append({
-                "role": "tool",
-                "tool_call_id": tc.id,
-                "content": output,
-            })
+        for idx in sorted(calls):
+            output = await tasks[idx]
+            self.messages.append("tool", output, tool_call_id=calls[idx]["id"])
 
 
 async def agent_loop(agent: AsyncAgent):
@@ -228,14 +376,34 @@ async def agent_loop(agent: AsyncAgent):
         await asyncio.sleep(0)  # 显式让出控制权
 
 
-TASKS: dict[str, AsyncAgent] = {}
+# 任务表必须有界：否则长跑的 REPL/服务里每个 submit_task 都是一笔
+# 永不释放的内存（agent 还拖着整条 messages 历史）
+MAX_TASKS = 1024
+FINISHED_TTL = 300  # 完成的任务保留 5 分钟供查询，然后清掉
+
+TASKS: "OrderedDict[str, AsyncAgent]" = OrderedDict()
+
+
+async def _run_task(task_id: str, agent: AsyncAgent):
+    try:
+        await agent_loop(agent)
+    except Exception as e:
+        agent.state["status"] = "error"
+        agent.state["answer"] = str(e)
+        agent.done = True
+    finally:
+        # 答案已经留在 state 里，历史引用可以放掉了
+        agent.messages = MessageStore()
+        asyncio.get_running_loop().call_later(FINISHED_TTL, TASKS.pop, task_id, None)
 
 
 def submit_task(prompt: str) -> str:
     task_id = str(uuid.uuid4())
     agent = AsyncAgent(prompt)
     TASKS[task_id] = agent
-    asyncio.create_task(agent_loop(agent))
+    while len(TASKS) > MAX_TASKS:
+        TASKS.popitem(last=False)  # 超上限先淘汰最老的
+    asyncio.create_task(_run_task(task_id, agent))
     return task_id
 
 
@@ -271,7 +439,27 @@ async def repl():
         print("未知命令，请用: run <prompt> | status <task_id> | exit")
 
 
+def _install_fast_event_loop() -> None:
+    """
+    尽量换上更快的事件循环（纯加速，不改语义）：
+    uringcore (io_uring) > uvloop > 默认 asyncio。
+    两个都是可选依赖，装了就用，没装静默跳过。
+    """
+    try:
+        import uringcore
+        asyncio.set_event_loop_policy(uringcore.EventLoopPolicy())
+        return
+    except ImportError:
+        pass
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+
+
 if __name__ == "__main__":
+    _install_fast_event_loop()
     try:
         asyncio.run(repl())
     except KeyboardInterrupt: